@@ -0,0 +1,166 @@
+# autotune.py
+#
+# source code for probing the largest training (micro-)batch
+# size of the EC^2 VAE that fits within a memory budget
+
+
+# imports
+import time
+import weakref
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+
+# class definition
+class _PeakMemory(TorchDispatchMode):
+    # peak bytes of the tensors created while active, each storage
+    # counted once and released when its last tensor is freed. This
+    # sees backward, gradients, transients and the recomputation of
+    # checkpointed segments, which saved tensor hooks do not.
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.peak = 0
+        self.__storages = {}
+        self.__tracked = set()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and id(t) not in self.__tracked:
+                self.__track(t)
+
+        return out
+
+    def __track(self, t):
+        storage = t.untyped_storage()
+        ptr, n_bytes = storage.data_ptr(), storage.nbytes()
+        if n_bytes == 0:
+            return
+
+        if ptr not in self.__storages:
+            self.__storages[ptr] = [0, n_bytes]
+            self.live += n_bytes
+            self.peak = max(self.peak, self.live)
+        self.__storages[ptr][0] += 1
+        self.__tracked.add(id(t))
+        weakref.finalize(t, self.__release, id(t), ptr)
+
+    def __release(self, tensor_id, ptr):
+        self.__tracked.discard(tensor_id)
+        entry = self.__storages[ptr]
+        entry[0] -= 1
+        if entry[0] == 0:
+            del self.__storages[ptr]
+            self.live -= entry[1]
+
+
+# function definitions and implementations
+def _param_bytes(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def _is_oom(error):
+    # CUDA raises torch.OutOfMemoryError, the CPU allocator a plain
+    # RuntimeError ("DefaultCPUAllocator: can't allocate memory")
+    if isinstance(error, torch.OutOfMemoryError):
+        return True
+
+    message = str(error).lower()
+    return any(m in message for m in (
+        "out of memory", "can't allocate memory", "cannot allocate memory"
+    ))
+
+
+def measure_step(model, step_fn, batch_size, n_iters=2, resident_bytes=0):
+    # returns the peak training memory in bytes and the samples/sec
+    # of one forward and backward pass at batch_size. resident_bytes
+    # is CPU memory the step uses but does not allocate, e.g. the
+    # weights of a frozen teacher; the CUDA allocator already counts it
+    param_bytes = _param_bytes(model)
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+        step_fn(batch_size)
+        # Adam allocates its two moment buffers on the first update
+        peak_bytes = torch.cuda.max_memory_allocated() + 2 * param_bytes
+    else:
+        with _PeakMemory() as tracker:
+            step_fn(batch_size)
+        # the parameters and the two Adam moment buffers on top of
+        # everything the step allocated, gradients included
+        peak_bytes = tracker.peak + 3 * param_bytes + resident_bytes
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        step_fn(batch_size)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / n_iters
+
+    return peak_bytes, batch_size / elapsed
+
+
+def find_batch_size(model, step_fn, memory_budget_mb,
+                    max_batch_size, n_iters=2, resident_bytes=0):
+    # doubles the batch size until it no longer fits the budget,
+    # then bisects between the last fitting and first failing size
+    budget_bytes = memory_budget_mb * 1024 ** 2
+    results = {}
+
+    if not torch.cuda.is_available():
+        print("Memory probe counts torch tensors only, not allocator "
+              "overhead or arrays outside torch; leave headroom in "
+              "memory_budget_mb")
+
+    def fits(batch_size):
+        try:
+            peak_bytes, samples_per_sec = measure_step(
+                model, step_fn, batch_size, n_iters, resident_bytes
+            )
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            peak_bytes, samples_per_sec = float("inf"), 0.
+        finally:
+            model.zero_grad(set_to_none=True)
+
+        results[batch_size] = (peak_bytes, samples_per_sec)
+        print("batch size {:5d}: {:10.1f} MiB, {:10.1f} samples/sec".format(
+            batch_size, peak_bytes / 1024 ** 2, samples_per_sec))
+
+        return peak_bytes <= budget_bytes
+
+    lo, hi = 0, None
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        if not fits(batch_size):
+            hi = batch_size
+            break
+        lo = batch_size
+        batch_size *= 2
+
+    if hi is None:
+        if lo < max_batch_size and fits(max_batch_size):
+            lo = max_batch_size
+        else:
+            hi = max_batch_size
+
+    while hi is not None and hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid
+
+    if lo == 0:
+        raise ValueError(
+            "a batch of one does not fit in {} MiB".format(memory_budget_mb)
+        )
+
+    return lo, results
@@ -0,0 +1,292 @@
+# benchmark.py
+#
+# source code for benchmarking parts of the EC^2 VAE
+# training and inference pipeline
+
+
+# imports
+import argparse
+import json
+import os
+import time
+
+import torch
+from torch.distributions import Normal
+from torch.nn import functional as F
+from torch.profiler import profile, ProfilerActivity
+
+from utils import loss_function
+from losses import ec_squared_vae_loss
+from ec_squared_vae import ECSquaredVAE
+from inference_pool import InferencePool
+from rhythm_cache import RhythmCache
+from autotune import measure_step
+
+
+# function definitions and implementations
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def _device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _time_and_profile(step_fn, n_iters, n_warmup=5):
+    for _ in range(n_warmup):
+        step_fn()
+    _sync()
+
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        step_fn()
+    _sync()
+    elapsed = (time.perf_counter() - start) / n_iters
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    with profile(activities=activities, profile_memory=True) as prof:
+        step_fn()
+        _sync()
+
+    events = prof.key_averages()
+    n_allocs = sum(
+        e.count for e in events
+        if e.key in ("aten::empty", "aten::empty_strided",
+                     "aten::zeros", "aten::ones")
+    )
+    alloc_bytes = sum(max(e.self_cpu_memory_usage, 0) for e in events)
+    if torch.cuda.is_available():
+        alloc_bytes += sum(
+            max(e.self_cuda_memory_usage, 0) for e in events
+        )
+
+    return elapsed, n_allocs, alloc_bytes
+
+
+def benchmark_loss(batch_size=128, time_step=32, roll_dim=130,
+                   rhythm_dim=3, z_dim=128, beta=.1, n_iters=100):
+    device = _device()
+    torch.manual_seed(0)
+
+    logits = torch.randn(batch_size, time_step, roll_dim,
+                         device=device, requires_grad=True)
+    rhythm_logits = torch.randn(batch_size, time_step, rhythm_dim,
+                                device=device, requires_grad=True)
+    target = torch.randint(roll_dim, (batch_size * time_step,),
+                           device=device)
+    rhythm_target = torch.randint(rhythm_dim, (batch_size * time_step,),
+                                  device=device)
+    dis1m = torch.randn(batch_size, z_dim, device=device,
+                        requires_grad=True)
+    dis2m = torch.randn(batch_size, z_dim, device=device,
+                        requires_grad=True)
+    dis1s = torch.randn(batch_size, z_dim, device=device).mul_(.1).exp_()
+    dis2s = torch.randn(batch_size, z_dim, device=device).mul_(.1).exp_()
+    dis1s.requires_grad_()
+    dis2s.requires_grad_()
+
+    def legacy_step():
+        # the decoders used to materialise log_softmax themselves
+        recon = F.log_softmax(logits, -1)
+        recon_rhythm = F.log_softmax(rhythm_logits, -1)
+        loss = loss_function(
+            recon, recon_rhythm, target, rhythm_target,
+            Normal(dis1m, dis1s), Normal(dis2m, dis2s), 0, beta=beta
+        )
+        loss.backward()
+        return loss
+
+    def fused_step():
+        loss, _ = ec_squared_vae_loss(
+            logits, rhythm_logits, target, rhythm_target,
+            dis1m, dis1s, dis2m, dis2s, beta=beta
+        )
+        loss.backward()
+        return loss
+
+    legacy_loss = legacy_step().detach()
+    fused_loss = fused_step().detach()
+    max_diff = (legacy_loss - fused_loss).abs().item()
+    assert torch.allclose(legacy_loss, fused_loss, rtol=1e-5, atol=1e-6), \
+        "fused loss differs from the legacy loss by {}".format(max_diff)
+
+    print("loss benchmark on {} (batch {}, {} steps)".format(
+        device, batch_size, time_step))
+    print("abs difference between losses: {:.3e}".format(max_diff))
+
+    for name, step_fn in (("legacy", legacy_step), ("fused", fused_step)):
+        elapsed, n_allocs, alloc_bytes = _time_and_profile(
+            step_fn, n_iters
+        )
+        print("{:>8}: {:8.3f} ms/step, {:4d} allocations, "
+              "{:8.1f} KiB allocated".format(
+                  name, elapsed * 1e3, n_allocs, alloc_bytes / 1024))
+
+
+def _config_model(config_file_path, **overrides):
+    with open(config_file_path) as f:
+        args = json.load(f)
+    args.update(overrides)
+
+    model = ECSquaredVAE(
+        args["roll_dim"], args["hidden_dim"], args["rhythm_dim"],
+        args["condition_dims"], args["z1_dim"],
+        args["z2_dim"], args["time_step"],
+        return_logits=args.get("return_logits", False),
+        checkpoint_segment=args.get("checkpoint_segment", 0)
+    )
+
+    return model, args
+
+
+def benchmark_inference_pool(config_file_path, batch_size=16,
+                             n_requests=64, pin_cores=True):
+    # throughput is independent of the trained weights, so a
+    # freshly initialised model of the configured size is used
+    model, args = _config_model(config_file_path)
+    torch.manual_seed(0)
+    requests = [
+        (torch.randn(batch_size, args["z1_dim"]),
+         torch.randn(batch_size, args["z2_dim"]),
+         torch.rand(batch_size, args["time_step"], args["condition_dims"]))
+        for _ in range(n_requests)
+    ]
+
+    n_cores = os.cpu_count()
+    n_workers = 1
+    print("inference pool scaling ({} cores, batch {}, {} requests)".format(
+        n_cores, batch_size, n_requests))
+    while n_workers <= n_cores:
+        pool = InferencePool(model, n_workers=n_workers,
+                             pin_cores=pin_cores)
+        pool.map(requests[:n_workers])  # warm up every worker
+
+        start = time.perf_counter()
+        pool.map(requests)
+        elapsed = time.perf_counter() - start
+        pool.close()
+
+        print("{:4d} workers x {:3d} threads: {:8.1f} clips/sec".format(
+            n_workers, max(1, n_cores // n_workers),
+            n_requests * batch_size / elapsed))
+        n_workers *= 2
+
+
+def benchmark_rhythm_cache(config_file_path, batch_size=16,
+                           n_requests=64, n_rhythms=8):
+    # analogy requests that draw their rhythm latent from a small
+    # pool while varying the pitch latents and chord conditions
+    model, args = _config_model(config_file_path)
+    model.eval()
+    torch.manual_seed(0)
+    rhythms = torch.randn(n_rhythms, args["z2_dim"])
+    requests = [
+        (torch.randn(batch_size, args["z1_dim"]),
+         rhythms[torch.randint(n_rhythms, (1,))].expand(batch_size, -1),
+         torch.rand(batch_size, args["time_step"], args["condition_dims"]))
+        for _ in range(n_requests)
+    ]
+    cache = RhythmCache(model)
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        for z1, z2, condition in requests:
+            model.decoder(z1, z2, condition)
+        uncached = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for z1, z2, condition in requests:
+            cache.decode(z1, z2, condition)
+        cached = time.perf_counter() - start
+
+    print("rhythm cache ({} rhythms, batch {}, {} requests)".format(
+        n_rhythms, batch_size, n_requests))
+    print("uncached: {:8.3f} ms/request".format(uncached / n_requests * 1e3))
+    print("  cached: {:8.3f} ms/request".format(cached / n_requests * 1e3))
+    print("   stats: {}".format(cache.get_stats()))
+
+
+def benchmark_checkpoint(config_file_path, batch_size=16,
+                         time_steps=(64, 128, 256),
+                         segments=(0, 8, 16, 32), hidden_dim=None):
+    # peak training memory and throughput of one forward/backward
+    # pass for each sequence length and checkpoint segment size
+    overrides = {"return_logits": True}
+    if hidden_dim is not None:
+        overrides["hidden_dim"] = hidden_dim
+
+    print("activation checkpointing (batch {})".format(batch_size))
+    for time_step in time_steps:
+        for segment in segments:
+            model, args = _config_model(
+                config_file_path, time_step=time_step,
+                checkpoint_segment=segment, **overrides
+            )
+            model.to(_device()).train()
+            torch.manual_seed(0)
+            tokens = torch.randint(args["roll_dim"],
+                                   (batch_size, time_step))
+            x = F.one_hot(tokens, args["roll_dim"]).float().to(_device())
+            c = torch.rand(batch_size, time_step,
+                           args["condition_dims"], device=_device())
+            target = tokens.view(-1).to(_device())
+
+            def step_fn(_):
+                recon, recon_rhythm, dis1m, dis1s, dis2m, dis2s = model(x, c)
+                rhythm_target = recon_rhythm.detach().argmax(-1).view(-1)
+                loss, _ = ec_squared_vae_loss(
+                    recon, recon_rhythm, target, rhythm_target,
+                    dis1m, dis1s, dis2m, dis2s
+                )
+                loss.backward()
+
+            peak_bytes, samples_per_sec = measure_step(
+                model, step_fn, batch_size
+            )
+            print("{:4d} steps, segment {:3s}: {:10.1f} MiB, "
+                  "{:8.1f} samples/sec".format(
+                      time_step, str(segment or "off"),
+                      peak_bytes / 1024 ** 2, samples_per_sec))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark",
+                        choices=["loss", "inference_pool", "rhythm_cache",
+                                 "checkpoint"])
+    parser.add_argument("--config", type=str,
+                        default="ec_squared_vae_model_config.json")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--time_step", type=int, default=32)
+    parser.add_argument("--n_iters", type=int, default=100)
+    parser.add_argument("--n_requests", type=int, default=64)
+    parser.add_argument("--hidden_dim", type=int, default=None)
+    parser.add_argument("--no_pin_cores", dest="pin_cores",
+                        action="store_false")
+    args = parser.parse_args()
+
+    if args.benchmark == "loss":
+        benchmark_loss(batch_size=args.batch_size,
+                       time_step=args.time_step,
+                       n_iters=args.n_iters)
+    elif args.benchmark == "inference_pool":
+        benchmark_inference_pool(args.config,
+                                 batch_size=args.batch_size,
+                                 n_requests=args.n_requests,
+                                 pin_cores=args.pin_cores)
+    elif args.benchmark == "rhythm_cache":
+        benchmark_rhythm_cache(args.config,
+                               batch_size=args.batch_size,
+                               n_requests=args.n_requests)
+    elif args.benchmark == "checkpoint":
+        benchmark_checkpoint(args.config,
+                             batch_size=args.batch_size,
+                             hidden_dim=args.hidden_dim)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,65 @@
+import os
+
 import numpy as np
-from sklearn.utils import shuffle
+
+
+# arrays of a memory-mapped dataset directory: the per-window ones,
+# then the metadata index of every window occurrence written by
+# preprocessing, which kept_index resolves to the stored windows
+MEMMAP_KEYS = ('pitch', 'chord', 'count', 'split', 'onset_low',
+               'onset_high', 'song', 'song_names', 'key', 'window', 'kept_index')
+
+# the key shifts preprocess_midi_data materialises with --shift
+KEY_SHIFTS = np.arange(-5, 7)
+
+
+def save_memmap_dataset(data_path, out_dir):
+    # rewrite a pickled processed_data.npy as one plain .npy file per
+    # key, which loaders in several processes can map read-only
+    data = np.load(data_path, allow_pickle=True)[()]
+    os.makedirs(out_dir, exist_ok=True)
+    for key in MEMMAP_KEYS:
+        if key in data:
+            np.save(os.path.join(out_dir, key + '.npy'), np.asarray(data[key]))
+
+    return out_dir
+
+
+def load_dataset(data_path):
+    if os.path.isdir(data_path):
+        return {
+            key: np.load(os.path.join(data_path, key + '.npy'), mmap_mode='r')
+            for key in MEMMAP_KEYS
+            if os.path.exists(os.path.join(data_path, key + '.npy'))
+        }
+
+    return np.load(data_path, allow_pickle=True)[()]
 
 
 class MusicArrayLoader():
-    def __init__(self, data_path, length, step_size):
-        self.dataset = np.load(data_path, allow_pickle=True)
+    def __init__(self, data_path, length, step_size, weighted=False,
+                 split=None, augment_shift=False, verbose=False):
+        self.dataset = load_dataset(data_path)
         self.__length = length  # 32
         self.__chunk_melodies = []
         self.__chunk_chords = []
+        self.__counts = None
+        self.__index = None
+        self.__order = None
         self.__current_index = 0
         self.__step_size = step_size  # 16
         self.__epoch = 0
+        # draw deduplicated windows in proportion to how often they
+        # occurred before deduplication
+        self.__weighted = weighted
+        # 'train', 'eval' or 'test', None keeps every window
+        self.__split = split
+        # transpose each drawn window by a random key shift, instead
+        # of storing the 12 shifted copies
+        self.__augment_shift = augment_shift
+        self.__shift_offsets = None
+        self.__valid_shifts = None
+        self.__verbose = verbose
 
     def __clipping(self, melody, chord):
         """
@@ -36,21 +85,170 @@ class MusicArrayLoader():
         return clipped_melodies, clipped_chords
 
     def chunking(self):
-        for melody, chord in zip(self.dataset[()]['pitch'], self.dataset[()]['chord']):
-            # melody.shape = (N, 130), chord.shape = (N, 12) N is length of individual example i.e. 32
-            # m, c = self.__clipping(melody, chord)
-            # self.__chunk_melodies += m
-            # self.__chunk_chords += c
-            print(melody.shape)
-            self.__chunk_melodies += [melody]
-            self.__chunk_chords += [chord]
-            
-        self.__chunk_melodies = np.asarray(self.__chunk_melodies)
-        self.__chunk_chords = np.asarray(self.__chunk_chords)
+        pitch, chord = self.dataset['pitch'], self.dataset['chord']
+        if isinstance(pitch, np.ndarray) and pitch.ndim == 3:
+            # already stacked windows, possibly memory-mapped, are
+            # used in place rather than copied
+            self.__chunk_melodies = pitch
+            self.__chunk_chords = np.asarray(chord)
+        else:
+            for melody, chord in zip(pitch, chord):
+                # melody.shape = (N, 130), chord.shape = (N, 12) N is length of individual example i.e. 32
+                # m, c = self.__clipping(melody, chord)
+                # self.__chunk_melodies += m
+                # self.__chunk_chords += c
+                if self.__verbose:
+                    print(melody.shape)
+                self.__chunk_melodies += [melody]
+                self.__chunk_chords += [chord]
+
+            self.__chunk_melodies = np.asarray(self.__chunk_melodies)
+            self.__chunk_chords = np.asarray(self.__chunk_chords)
         assert (len(self.__chunk_melodies) == len(self.__chunk_chords))
 
+        # datasets saved before deduplication carry no counts
+        self.__counts = np.asarray(
+            self.dataset.get('count', np.ones(len(self.__chunk_melodies))),
+            dtype=np.float64
+        )
+        assert (len(self.__counts) == len(self.__chunk_melodies))
+
+        if self.__augment_shift:
+            self.__init_shifts()
+
+        # the windows this loader draws from, as indices into the
+        # stored arrays so filtering never copies them
+        self.set_view(self.find_windows(split=self.__split))
+
+    def __kept_index(self):
+        # stored window of every metadata occurrence; datasets written
+        # before duplicates were recorded hold one occurrence per window
+        if 'kept_index' in self.dataset:
+            return np.asarray(self.dataset['kept_index'])
+
+        return np.arange(len(self.__chunk_melodies))
+
+    def find_windows(self, split=None, song=None, key=None,
+                     window_range=None):
+        # indices of the windows with an occurrence matching every
+        # given filter, so a deduplicated window is found from any of
+        # the songs it occurred in. song is a title or list of titles,
+        # key a key shift or list of shifts, window_range a half-open
+        # (first, last) window offset range. Filters whose metadata
+        # the dataset lacks are ignored.
+        mask = np.ones(len(self.__chunk_melodies), dtype=bool)
+
+        if split is not None and 'split' in self.dataset:
+            mask &= np.isin(self.dataset['split'], np.atleast_1d(split))
+
+        occurrences = None
+        if song is not None and 'song' in self.dataset:
+            song_names = list(self.dataset['song_names'])
+            unknown = [str(s) for s in np.atleast_1d(song)
+                       if s not in song_names]
+            if unknown:
+                raise KeyError('unknown song titles: {}'.format(unknown))
+            codes = [song_names.index(s) for s in np.atleast_1d(song)]
+            occurrences = np.isin(self.dataset['song'], codes)
+
+        if key is not None and 'key' in self.dataset:
+            matches = np.isin(self.dataset['key'], np.atleast_1d(key))
+            occurrences = matches if occurrences is None \
+                else occurrences & matches
+
+        if window_range is not None and 'window' in self.dataset:
+            window = np.asarray(self.dataset['window'])
+            matches = (window >= window_range[0]) & (window < window_range[1])
+            occurrences = matches if occurrences is None \
+                else occurrences & matches
+
+        if occurrences is not None:
+            found = np.zeros(len(mask), dtype=bool)
+            found[self.__kept_index()[occurrences]] = True
+            mask &= found
+
+        return np.nonzero(mask)[0]
+
+    def set_view(self, index):
+        # restrict batches to the given window indices, e.g. from
+        # find_windows, and start a fresh epoch over them
+        self.__index = np.asarray(index)
+        self.__order = self.__index.copy()
+        self.reset()
+
+    def get_windows(self, index):
+        # the stored windows at the given indices, in order
+        self.check()
+        return self.__chunk_melodies[index], self.__chunk_chords[index]
+
+    def get_metadata(self, index):
+        # song title, key shift and window offset of the first
+        # occurrence of each window, and its split
+        _, first = np.unique(self.__kept_index(), return_index=True)
+        first = first[index]
+
+        metadata = {}
+        if 'song' in self.dataset:
+            metadata['song'] = np.asarray(
+                self.dataset['song_names'])[self.dataset['song'][first]]
+        for name in ('key', 'window'):
+            if name in self.dataset:
+                metadata[name] = np.asarray(self.dataset[name][first])
+        if 'split' in self.dataset:
+            metadata['split'] = np.asarray(self.dataset['split'][index])
+
+        return metadata
+
+    def __init_shifts(self):
+        # token offset and validity of every (window, key shift) pair
+        n_pitch = self.__chunk_melodies.shape[-1] - 2
+        tokens = self.__chunk_melodies.argmax(-1)
+        if 'onset_low' in self.dataset:
+            # the preprocessor takes the base note and range from one
+            # frame more than it stores, so its onset range is kept
+            min_pitch = np.asarray(self.dataset['onset_low'], dtype=np.int64)
+            max_pitch = np.asarray(self.dataset['onset_high'], dtype=np.int64)
+        else:
+            # older datasets: the stored tokens only, which can differ
+            # from the preprocessor by an octave when the extra frame
+            # holds the lowest or highest onset
+            pitched = tokens < n_pitch
+            min_pitch = np.where(pitched, tokens, n_pitch).min(-1)
+            max_pitch = np.where(pitched, tokens, -1).max(-1)
+
+        offsets = np.broadcast_to(
+            KEY_SHIFTS, (len(tokens), len(KEY_SHIFTS))).copy()
+        if n_pitch < 128:
+            # tokens are relative to the octave of the lowest note,
+            # which the preprocessor recomputes after shifting
+            offsets -= 12 * ((min_pitch[:, None] + KEY_SHIFTS) // 12)
+
+        # pairs the preprocessor would have skipped for going out of range
+        self.__valid_shifts = (max_pitch[:, None] + offsets < n_pitch) & \
+            (min_pitch[:, None] + offsets >= 0)
+        self.__shift_offsets = offsets
+
+    def __transpose(self, idx, melodies, chords):
+        # one valid key shift per window, drawn uniformly and applied
+        # to the whole batch at once
+        n_pitch = melodies.shape[-1] - 2
+        choice = np.where(
+            self.__valid_shifts[idx], np.random.rand(len(idx), len(KEY_SHIFTS)), -1.
+        ).argmax(1)
+        shifts = KEY_SHIFTS[choice]
+        offsets = self.__shift_offsets[idx, choice]
+
+        tokens = melodies.argmax(-1)
+        tokens = np.where(tokens < n_pitch, tokens + offsets[:, None], tokens)
+        melodies = np.eye(n_pitch + 2, dtype=melodies.dtype)[tokens]
+
+        chord_idx = (np.arange(12)[None, :] - shifts[:, None]) % 12
+        chords = np.take_along_axis(chords, chord_idx[:, None, :], axis=2)
+
+        return melodies, chords
+
     def get_n_music(self):
-        return len(self.dataset[0])
+        return len(self.dataset['pitch'])
 
     def check(self):
         if len(self.__chunk_melodies) == 0:
@@ -58,7 +256,7 @@ class MusicArrayLoader():
 
     def get_n_sample(self):
         self.check()
-        return len(self.__chunk_melodies)
+        return len(self.__index)
 
     def get_n_epoch(self):
         return self.__epoch
@@ -67,10 +265,22 @@ class MusicArrayLoader():
         self.__current_index = 0
         self.__epoch = 0
 
+    def get_duplicate_ratio(self):
+        self.check()
+        counts = self.__counts[self.__index]
+        return 1. - len(counts) / counts.sum()
+
     def shuffle_samples(self):
         self.check()
-        self.__chunk_melodies, self.__chunk_chords = shuffle(
-            self.__chunk_melodies, self.__chunk_chords)
+        if self.__weighted:
+            counts = self.__counts[self.__index]
+            if self.__augment_shift:
+                # the materialised dataset holds one copy per valid shift
+                counts = counts * self.__valid_shifts[self.__index].sum(1)
+            self.__order = np.random.choice(
+                self.__index, len(self.__index), p=counts / counts.sum())
+        else:
+            self.__order = np.random.permutation(self.__index)
 
     def get_batch(self, batch_size):
         self.check()
@@ -78,10 +288,14 @@ class MusicArrayLoader():
             t = self.__current_index
             self.__current_index = 0
             self.__epoch += 1
-            return self.__chunk_melodies[t:], self.__chunk_chords[t:]
+            idx = self.__order[t:]
         else:
             t = self.__current_index
             self.__current_index += batch_size
-            return self.__chunk_melodies[
-                t:self.__current_index], self.__chunk_chords[
-                    t:self.__current_index]
+            idx = self.__order[t:self.__current_index]
+
+        melodies, chords = self.__chunk_melodies[idx], self.__chunk_chords[idx]
+        if self.__augment_shift and len(idx) > 0:
+            melodies, chords = self.__transpose(idx, melodies, chords)
+
+        return melodies, chords
@@ -0,0 +1,185 @@
+# distill.py
+#
+# source code for distilling a trained EC^2 VAE teacher into a
+# smaller student, and for comparing the two
+
+
+# imports
+import argparse
+import json
+import os
+import time
+
+import torch
+
+from ec_squared_vae import ECSquaredVAE
+from data_loader import MusicArrayLoader
+from evaluate import evaluate
+from utils import load_checkpoint, prepare_batch
+
+
+# function definitions and implementations
+def build_model(args, hidden_dim=None, **kwargs):
+    return ECSquaredVAE(
+        args["roll_dim"], hidden_dim or args["hidden_dim"],
+        args["rhythm_dim"], args["condition_dims"], args["z1_dim"],
+        args["z2_dim"], args["time_step"], **kwargs
+    )
+
+
+def load_teacher(args, params_root):
+    # frozen, kept in training mode with full teacher forcing, so its
+    # per-step distributions are conditioned on the ground truth
+    teacher = build_model(
+        args, args["teacher_hidden_dim"], return_logits=True
+    )
+    load_checkpoint(
+        teacher,
+        os.path.join(params_root, "{}.pt".format(args["teacher_name"]))
+    )
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    teacher.train()
+    teacher.eps = 1.
+
+    if torch.cuda.is_available():
+        teacher.cuda()
+
+    return teacher
+
+
+@torch.no_grad()
+def teacher_targets(teacher, x, condition):
+    # logits decoded from the latent means, and the means themselves
+    teacher.set_teacher_forcing(x)
+    dis1, dis2 = teacher.encoder(x, condition)
+    rhythm = teacher.rhythm_decoder(dis2.mean)
+    recon = teacher.final_decoder(
+        dis1.mean, teacher.rhythm_input(rhythm), condition
+    )
+
+    return recon, rhythm, dis1.mean, dis2.mean
+
+
+def _rhythm_of(tokens, n_pitch):
+    # pitch/hold/rest tokens to the 3-way onset/hold/rest rhythm
+    return torch.where(
+        tokens < n_pitch, torch.zeros_like(tokens), tokens - n_pitch + 1
+    )
+
+
+@torch.no_grad()
+def analogy_accuracy(model, dl, args, device="cpu"):
+    # decode z1 of each window with z2 of another; the output should
+    # follow the rhythm of the z2 window. Also returns the decoded
+    # tokens so the student's analogies can be compared to the teacher's
+    model.eval()
+    correct, total, outputs = 0., 0, []
+    n_pitch = args["roll_dim"] - 2
+
+    dl.reset()
+    while dl.get_n_epoch() == 0:
+        batch, c = dl.get_batch(args["eval_batch_size"])
+        if len(batch) < 2:
+            break
+
+        x, c, _, rhythm_target = prepare_batch(batch, c, device)
+        dis1, dis2 = model.encoder(x, c)
+        perm = torch.roll(torch.arange(len(batch), device=device), 1)
+        tokens = model.decoder(dis1.mean, dis2.mean[perm], c).argmax(-1)
+
+        rhythm_target = rhythm_target.view(len(batch), -1)[perm]
+        correct += (_rhythm_of(tokens, n_pitch) == rhythm_target).sum().item()
+        total += rhythm_target.numel()
+        outputs.append(tokens.cpu())
+    dl.reset()
+
+    return correct / max(total, 1), outputs
+
+
+def decode_latency(model, args, batch_size=1, n_iters=20):
+    model.eval()
+    z1 = torch.randn(batch_size, args["z1_dim"])
+    z2 = torch.randn(batch_size, args["z2_dim"])
+    c = torch.rand(batch_size, args["time_step"], args["condition_dims"])
+
+    with torch.no_grad():
+        model.decoder(z1, z2, c)
+        start = time.perf_counter()
+        for _ in range(n_iters):
+            model.decoder(z1, z2, c)
+
+    return (time.perf_counter() - start) / n_iters
+
+
+def distill_report(config_fname, student_name=None):
+    # latency, size and accuracy of the student against its teacher
+    with open(config_fname) as f:
+        args = json.load(f)
+
+    params_root = args.get("params_dir", "ec_squared_vae/params")
+    student_name = student_name or args["name"]
+    models = {
+        "teacher": load_checkpoint(
+            build_model(args, args["teacher_hidden_dim"]),
+            os.path.join(params_root, "{}.pt".format(args["teacher_name"]))
+        ),
+        "student": load_checkpoint(
+            build_model(args),
+            os.path.join(params_root, "{}.pt".format(student_name))
+        )
+    }
+
+    dl = MusicArrayLoader(
+        args["data_path"], args["time_step"], 16,
+        split=args.get("eval_split", "eval")
+    )
+    dl.chunking()
+
+    rows, analogies = {}, {}
+    for name, model in models.items():
+        accuracy = evaluate(model, dl, args)
+        rows[name] = {
+            "params": sum(p.numel() for p in model.parameters()),
+            "latency_ms": decode_latency(model, args) * 1e3,
+            "pitch_accuracy": accuracy["pitch_accuracy"],
+            "rhythm_accuracy": accuracy["rhythm_accuracy"]
+        }
+        rows[name]["analogy_rhythm_accuracy"], analogies[name] = \
+            analogy_accuracy(model, dl, args)
+
+    agreement = torch.cat([
+        (s == t).float().view(-1)
+        for s, t in zip(analogies["student"], analogies["teacher"])
+    ]).mean().item() if analogies["student"] else 0.
+
+    print("{:>8}  {:>12}  {:>10}  {:>9}  {:>9}  {:>9}".format(
+        "", "params", "latency_ms", "pitch_acc", "rhythm_acc",
+        "analogy"))
+    for name, row in rows.items():
+        print("{:>8}  {:12d}  {:10.2f}  {:9.4f}  {:9.4f}  {:9.4f}".format(
+            name, row["params"], row["latency_ms"], row["pitch_accuracy"],
+            row["rhythm_accuracy"], row["analogy_rhythm_accuracy"]))
+    print("speed-up: {:.2f}x, {:.2f}x fewer parameters".format(
+        rows["teacher"]["latency_ms"] / rows["student"]["latency_ms"],
+        rows["teacher"]["params"] / rows["student"]["params"]))
+    print("student/teacher analogy token agreement: {:.4f}".format(
+        agreement))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config", type=str,
+        default="ec_squared_vae/code/ec_squared_vae_model_config.json"
+    )
+    parser.add_argument("--student_name", type=str, default=None)
+    args = parser.parse_args()
+
+    distill_report(args.config, args.student_name)
+
+
+if __name__ == "__main__":
+    main()
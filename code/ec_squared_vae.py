@@ -8,13 +8,14 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.distributions import Normal
+from torch.utils.checkpoint import checkpoint
 
 
 # class definition
 class ECSquaredVAE(nn.Module):
     def __init__(self, roll_dims, hidden_dims, rhythm_dims,
                  condition_dims, z1_dims, z2_dims, n_step,
-                 k=1000):
+                 k=1000, return_logits=False, checkpoint_segment=0):
 
         super(ECSquaredVAE, self).__init__()
 
@@ -49,20 +50,32 @@ class ECSquaredVAE(nn.Module):
         self.z1_dims = z1_dims
         self.z2_dims = z2_dims
         self.k = torch.FloatTensor([k])
+        # when set, the decoders return raw logits so the loss
+        # can fuse log_softmax into the cross entropy
+        self.return_logits = return_logits
+        # when positive, training recomputes the decoder loops in
+        # segments of this many steps during backward instead of
+        # keeping every step's activations
+        self.checkpoint_segment = checkpoint_segment
 
 
     def _sampling(self, x):
         idx = x.max(1)[1]
         x = torch.zeros_like(x)
-        arange = torch.arange(x.size(0)).long()
-
-        if torch.cuda.is_available():
-            arange = arange.cuda()
+        arange = torch.arange(x.size(0), device=x.device)
         x[arange, idx] = 1
 
         return x
 
 
+    def update_eps(self):
+        # teacher forcing schedule, advanced once per optimizer
+        # update rather than once per (micro-)batch forward pass
+        self.iteration += 1
+        self.eps = self.k / \
+            (self.k + torch.exp(self.iteration / self.k))
+
+
     def encoder(self, x, condition):
         # self.gru_0.flatten_parameters()
         x = torch.cat((x, condition), -1)
@@ -81,20 +94,47 @@ class ECSquaredVAE(nn.Module):
         return distribution_1, distribution_2
 
 
-    def rhythm_decoder(self, z):
-        out = torch.zeros((z.size(0), self.rhythm_dims))
-        out[:, -1] = 1.
-        x = []
-        t = torch.tanh(self.linear_init_0(z))
-        hx = t
+    def _rhythm_step(self, out, z, hx):
+        out = torch.cat([out, z], 1)
+        hx = self.grucell_0(out, hx)
+        out = self.linear_out_0(hx)
+        if not self.return_logits:
+            out = F.log_softmax(out, 1)
+
+        return out, hx
+
+
+    def _final_step(self, out, rhythm, z, condition, hx):
+        # hx is [grucell_1 state, grucell_2 state], updated in place
+        out = torch.cat([out, rhythm, z, condition], 1)
+        hx[0] = self.grucell_1(out, hx[0])
+
+        if hx[1] is None:
+            hx[1] = hx[0]
+
+        hx[1] = self.grucell_2(hx[0], hx[1])
+        out = self.linear_out_1(hx[1])
+        if not self.return_logits:
+            out = F.log_softmax(out, 1)
+
+        return out
+
 
-        if torch.cuda.is_available():
-            out = out.cuda()
+    def _segments(self):
+        segment = self.n_step
+        if self.training and self.checkpoint_segment > 0 \
+                and torch.is_grad_enabled():
+            segment = self.checkpoint_segment
 
-        for i in range(self.n_step):
-            out = torch.cat([out, z], 1)
-            hx = self.grucell_0(out, hx)
-            out = F.log_softmax(self.linear_out_0(hx), 1)
+        for start in range(0, self.n_step, segment):
+            yield start, min(start + segment, self.n_step), \
+                segment < self.n_step
+
+
+    def _rhythm_segment(self, out, hx, z, start, end):
+        x = []
+        for i in range(start, end):
+            out, hx = self._rhythm_step(out, z, hx)
             x.append(out)
 
             if self.training:
@@ -107,30 +147,16 @@ class ECSquaredVAE(nn.Module):
             else:
                 out = self._sampling(out)
 
-        return torch.stack(x, 1)
+        return torch.stack(x, 1), out, hx
 
 
-    def final_decoder(self, z, rhythm, condition):
-        out = torch.zeros((z.size(0), self.roll_dims))
-        out[:, -1] = 1.
-        x, hx = [], [None, None]
-        t = torch.tanh(self.linear_init_1(z))
-        hx[0] = t
-
-        if torch.cuda.is_available():
-            out = out.cuda()
-
-        for i in range(self.n_step):
-            out = torch.cat(
-                [out, rhythm[:, i, :], z, condition[:, i, :]], 1
+    def _final_segment(self, out, h0, h1, z, rhythm, condition,
+                       start, end):
+        x, hx = [], [h0, h1]
+        for i in range(start, end):
+            out = self._final_step(
+                out, rhythm[:, i, :], z, condition[:, i, :], hx
             )
-            hx[0] = self.grucell_1(out, hx[0])
-
-            if i == 0:
-                hx[1] = hx[0]
-
-            hx[1] = self.grucell_2(hx[0], hx[1])
-            out = F.log_softmax(self.linear_out_1(hx[1]), 1)
             x.append(out)
 
             if self.training:
@@ -139,34 +165,136 @@ class ECSquaredVAE(nn.Module):
                     out = self.sample[:, i, :]
                 else:
                     out = self._sampling(out)
-                self.eps = self.k / \
-                    (self.k + torch.exp(self.iteration / self.k))
             else:
                 out = self._sampling(out)
 
-        return torch.stack(x, 1)
+        return torch.stack(x, 1), out, hx[0], hx[1]
+
+
+    def rhythm_decoder(self, z):
+        out = z.new_zeros((z.size(0), self.rhythm_dims))
+        out[:, -1] = 1.
+        x = []
+        t = torch.tanh(self.linear_init_0(z))
+        hx = t
+
+        for start, end, use_checkpoint in self._segments():
+            if use_checkpoint:
+                # the rng state is restored on recomputation, so the
+                # teacher forcing draws are replayed identically
+                seg, out, hx = checkpoint(
+                    self._rhythm_segment, out, hx, z, start, end,
+                    use_reentrant=False
+                )
+            else:
+                seg, out, hx = self._rhythm_segment(out, hx, z, start, end)
+            x.append(seg)
+
+        return torch.cat(x, 1)
+
+
+    def final_decoder(self, z, rhythm, condition):
+        out = z.new_zeros((z.size(0), self.roll_dims))
+        out[:, -1] = 1.
+        x, hx = [], [None, None]
+        t = torch.tanh(self.linear_init_1(z))
+        hx[0] = t
+
+        for start, end, use_checkpoint in self._segments():
+            if use_checkpoint:
+                seg, out, hx[0], hx[1] = checkpoint(
+                    self._final_segment, out, hx[0], hx[1], z, rhythm,
+                    condition, start, end, use_reentrant=False
+                )
+            else:
+                seg, out, hx[0], hx[1] = self._final_segment(
+                    out, hx[0], hx[1], z, rhythm, condition, start, end
+                )
+            x.append(seg)
+
+        return torch.cat(x, 1)
+
+
+    def rhythm_input(self, rhythm):
+        # the final decoder is always conditioned on rhythm
+        # log-probabilities, whatever the rhythm decoder returns
+        if self.return_logits:
+            return F.log_softmax(rhythm, -1)
+
+        return rhythm
 
 
     def decoder(self, z1, z2, condition=None):
         rhythm = self.rhythm_decoder(z2)
 
-        return self.final_decoder(z1, rhythm, condition)
+        return self.final_decoder(z1, self.rhythm_input(rhythm), condition)
+
+
+    @torch.no_grad()
+    def stream_decoder(self, z1, z2, condition, state=None,
+                       steps_per_chunk=1):
+        # yields (rhythm_tokens, pitch_tokens, state) every
+        # steps_per_chunk steps, e.g. 16 for one bar, as soon as they
+        # are decoded. Passing the last state into the next call
+        # continues from the previous clip's hidden states instead of
+        # restarting from z.
+        if state is None:
+            rhythm_out = z2.new_zeros((z2.size(0), self.rhythm_dims))
+            rhythm_out[:, -1] = 1.
+            out = z1.new_zeros((z1.size(0), self.roll_dims))
+            out[:, -1] = 1.
+            state = {
+                "rhythm_out": rhythm_out,
+                "rhythm_hx": torch.tanh(self.linear_init_0(z2)),
+                "out": out,
+                "hx": [torch.tanh(self.linear_init_1(z1)), None]
+            }
+        else:
+            state = dict(state, hx=list(state["hx"]))
+
+        rhythm_tokens, pitch_tokens = [], []
+        for i in range(condition.size(1)):
+            rhythm, state["rhythm_hx"] = self._rhythm_step(
+                state["rhythm_out"], z2, state["rhythm_hx"]
+            )
+            state["rhythm_out"] = self._sampling(rhythm)
+
+            out = self._final_step(
+                state["out"], self.rhythm_input(rhythm), z1,
+                condition[:, i, :], state["hx"]
+            )
+            state["out"] = self._sampling(out)
+
+            rhythm_tokens.append(rhythm.argmax(-1))
+            pitch_tokens.append(out.argmax(-1))
+
+            if len(pitch_tokens) == steps_per_chunk or \
+                    i == condition.size(1) - 1:
+                yield (torch.stack(rhythm_tokens, 1),
+                       torch.stack(pitch_tokens, 1), state)
+                rhythm_tokens, pitch_tokens = [], []
+
+
+    def set_teacher_forcing(self, x):
+        # ground truth pitch and rhythm fed back in training mode
+        self.sample = x
+        self.rhythm_sample = x[:, :, :-2].sum(-1).unsqueeze(-1)
+        self.rhythm_sample = torch.cat(
+            (self.rhythm_sample, x[:, :, -2:]), -1
+        )
 
 
     def forward(self, x, condition):
         if self.training:
-            self.sample = x
-            self.rhythm_sample = x[:, :, :-2].sum(-1).unsqueeze(-1)
-            self.rhythm_sample = torch.cat(
-                (self.rhythm_sample, x[:, :, -2:]), -1
-            )
-            self.iteration += 1
+            self.set_teacher_forcing(x)
 
         dis1, dis2 = self.encoder(x, condition)
         z1 = dis1.rsample()
         z2 = dis2.rsample()
         recon_rhythm = self.rhythm_decoder(z2)
-        recon = self.final_decoder(z1, recon_rhythm, condition)
+        recon = self.final_decoder(
+            z1, self.rhythm_input(recon_rhythm), condition
+        )
 
         return (
             recon, recon_rhythm, dis1.mean,
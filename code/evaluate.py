@@ -0,0 +1,131 @@
+# evaluate.py
+#
+# source code for evaluating EC^2 VAE weight snapshots on the
+# held-out eval/test split in a background process
+
+
+# imports
+import queue
+
+import torch
+from torch import multiprocessing as mp
+from tensorboardX import SummaryWriter
+
+from ec_squared_vae import ECSquaredVAE
+from data_loader import MusicArrayLoader
+from losses import ec_squared_vae_loss
+from utils import prepare_batch
+
+
+# function definitions and implementations
+def evaluate(model, dl, args, device="cpu"):
+    # batched, no teacher forcing, decoding from the latent means
+    model.eval()
+    totals = {}
+    n_tokens, n_batches = 0, 0
+    pitch_correct, rhythm_correct = 0., 0.
+
+    dl.reset()
+    with torch.no_grad():
+        while dl.get_n_epoch() == 0:
+            batch, c = dl.get_batch(args["eval_batch_size"])
+            if len(batch) == 0:
+                break
+
+            encode_tensor, c, target_tensor, rhythm_target = \
+                prepare_batch(batch, c, device)
+            dis1, dis2 = model.encoder(encode_tensor, c)
+            recon_rhythm = model.rhythm_decoder(dis2.mean)
+            recon = model.final_decoder(
+                dis1.mean, model.rhythm_input(recon_rhythm), c
+            )
+
+            _, terms = ec_squared_vae_loss(
+                recon, recon_rhythm, target_tensor, rhythm_target,
+                dis1.mean, dis1.stddev, dis2.mean, dis2.stddev,
+                beta=args["beta"], from_logits=model.return_logits
+            )
+            for name, value in terms.items():
+                totals[name] = totals.get(name, 0.) + value.item()
+            n_batches += 1
+
+            pitch_correct += (
+                recon.reshape(-1, recon.size(-1)).argmax(-1) == target_tensor
+            ).sum().item()
+            rhythm_correct += (
+                recon_rhythm.reshape(-1, recon_rhythm.size(-1)).argmax(-1)
+                == rhythm_target
+            ).sum().item()
+            n_tokens += target_tensor.numel()
+
+    dl.reset()
+    metrics = {name: value / max(n_batches, 1)
+               for name, value in totals.items()}
+    metrics["pitch_accuracy"] = pitch_correct / max(n_tokens, 1)
+    metrics["rhythm_accuracy"] = rhythm_correct / max(n_tokens, 1)
+
+    return metrics
+
+
+def _eval_worker(args, log_dir, snapshots):
+    # keep the evaluator from competing with training for cores
+    torch.set_num_threads(args.get("eval_num_threads", 1))
+    device = args.get("eval_device", "cpu")
+
+    model = ECSquaredVAE(
+        args["roll_dim"], args["hidden_dim"], args["rhythm_dim"],
+        args["condition_dims"], args["z1_dim"],
+        args["z2_dim"], args["time_step"], return_logits=True
+    ).to(device)
+    dl = MusicArrayLoader(
+        args["data_path"], args["time_step"], 16,
+        split=args.get("eval_split", "eval")
+    )
+    dl.chunking()
+    writer = SummaryWriter(log_dir)
+
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+
+        step, state_dict = snapshot
+        model.load_state_dict(state_dict)
+        metrics = evaluate(model, dl, args, device)
+        for name, value in metrics.items():
+            writer.add_scalar("eval/{}".format(name), value, step)
+        writer.flush()
+
+    writer.close()
+
+
+class AsyncEvaluator():
+    def __init__(self, args, log_dir):
+        # at most one snapshot waits while another is evaluated,
+        # newer snapshots are dropped instead of blocking training
+        ctx = mp.get_context("spawn")
+        self.__snapshots = ctx.Queue(maxsize=1)
+        self.__process = ctx.Process(
+            target=_eval_worker,
+            args=(args, log_dir, self.__snapshots),
+            daemon=True
+        )
+        self.__process.start()
+
+    def submit(self, model, step):
+        if self.__snapshots.full():
+            return False
+
+        state_dict = {
+            k: v.detach().cpu().clone()
+            for k, v in model.state_dict().items()
+        }
+        try:
+            self.__snapshots.put_nowait((step, state_dict))
+            return True
+        except queue.Full:
+            return False
+
+    def close(self):
+        self.__snapshots.put(None)
+        self.__process.join()
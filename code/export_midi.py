@@ -0,0 +1,146 @@
+# export_midi.py
+#
+# source code for converting batches of decoded EC^2 VAE
+# pitch/hold/rest tokens and chord vectors back into midi files
+
+
+# imports
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pretty_midi as pm
+
+
+# token layout of the 130-way roll, as written by the preprocessor
+HOLD_TOKEN = 128
+REST_TOKEN = 129
+
+
+# function definitions and implementations
+def _next_index(is_break):
+    # for every (clip, step), the first step strictly after it where
+    # is_break holds, or the sequence length if there is none
+    n_step = is_break.shape[1]
+    idx = np.where(is_break, np.arange(n_step), n_step)
+    idx = np.minimum.accumulate(idx[:, ::-1], axis=1)[:, ::-1]
+
+    return np.concatenate(
+        (idx[:, 1:], np.full((len(idx), 1), n_step)), axis=1
+    )
+
+
+def tokens_to_notes(tokens, unit_time=0.125, base_note=0):
+    # tokens is (batch, n_step) or one-hot/log-probs (batch, n_step, 130)
+    # returns clip index, start, end and pitch arrays of every note,
+    # ordered by clip, where hold tokens extend the previous onset
+    tokens = np.asarray(tokens)
+    if tokens.ndim == 3:
+        tokens = tokens.argmax(-1)
+
+    is_onset = tokens < HOLD_TOKEN
+    end_step = _next_index(tokens != HOLD_TOKEN)
+
+    clip, step = np.nonzero(is_onset)
+    start = step * unit_time
+    end = end_step[clip, step] * unit_time
+    pitch = tokens[clip, step] + base_note
+
+    return clip, start, end, pitch
+
+
+def chords_to_notes(chords, unit_time=0.125, chord_base=48):
+    # chords is (batch, n_step, 12); each run of identical chord
+    # vectors becomes one note per active pitch class, plus a bass
+    # note an octave below on its lowest pitch class, since the
+    # preprocessor drops the lowest note of every chord as the bass
+    chords = np.asarray(chords) > .5
+    is_change = np.ones(chords.shape[:2], dtype=bool)
+    is_change[:, 1:] = (chords[:, 1:] != chords[:, :-1]).any(-1)
+    end_step = _next_index(is_change)
+
+    run_clip, run_step = np.nonzero(is_change)
+    run_chords = chords[run_clip, run_step]
+    note_run, pitch_class = np.nonzero(run_chords)
+    bass_run = np.nonzero(run_chords.any(-1))[0]
+
+    note_run = np.concatenate((bass_run, note_run))
+    pitch = np.concatenate((
+        run_chords[bass_run].argmax(-1) + chord_base - 12,
+        pitch_class + chord_base
+    ))
+    # keep the notes ordered by clip
+    order = np.argsort(run_clip[note_run], kind="stable")
+    note_run, pitch = note_run[order], pitch[order]
+    clip = run_clip[note_run]
+    step = run_step[note_run]
+
+    start = step * unit_time
+    end = end_step[clip, step] * unit_time
+
+    return clip, start, end, pitch
+
+
+def _split_by_clip(notes, batch_size):
+    clip, start, end, pitch = notes
+    bounds = np.searchsorted(clip, np.arange(batch_size + 1))
+
+    return [
+        (start[lo:hi], end[lo:hi], pitch[lo:hi])
+        for lo, hi in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def notes_to_pretty_midi(melody_notes, chord_notes=None,
+                         bpm=120, velocity=100):
+    # melody on the first instrument and chords on the second,
+    # the layout preprocess_midi_data reads
+    midi = pm.PrettyMIDI(initial_tempo=bpm)
+
+    for notes in (melody_notes, chord_notes):
+        if notes is None:
+            continue
+        instrument = pm.Instrument(program=0)
+        instrument.notes = [
+            pm.Note(velocity, int(p), float(s), float(e))
+            for s, e, p in zip(*notes)
+        ]
+        midi.instruments.append(instrument)
+
+    return midi
+
+
+def _write_midi(job):
+    path, melody_notes, chord_notes, bpm = job
+    notes_to_pretty_midi(melody_notes, chord_notes, bpm).write(path)
+
+    return path
+
+
+def export_batch(tokens, chords, out_dir, prefix="sample",
+                 frame_per_bar=16, beat_per_bar=4, bpm=120,
+                 base_note=0, n_workers=None):
+    # convert a whole batch at once, then write the files in a pool
+    frame_per_second = (frame_per_bar / beat_per_bar) * (bpm / 60)
+    unit_time = 1 / frame_per_second
+    batch_size = len(tokens)
+
+    melodies = _split_by_clip(
+        tokens_to_notes(tokens, unit_time, base_note), batch_size
+    )
+    if chords is not None:
+        chord_parts = _split_by_clip(
+            chords_to_notes(chords, unit_time), batch_size
+        )
+    else:
+        chord_parts = [None] * batch_size
+
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [
+        (os.path.join(out_dir, "{}_{:05d}.mid".format(prefix, i)),
+         melodies[i], chord_parts[i], bpm)
+        for i in range(batch_size)
+    ]
+
+    with Pool(n_workers) as pool:
+        return pool.map(_write_midi, jobs, chunksize=16)
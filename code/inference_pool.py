@@ -0,0 +1,138 @@
+# inference_pool.py
+#
+# source code for a pool of EC^2 VAE inference workers sharing
+# one read-only copy of the model weights
+
+
+# imports
+import os
+import pickle
+import queue
+
+import torch
+from torch import multiprocessing as mp
+
+
+# function definitions and implementations
+def _worker_cores(worker_id, threads_per_worker):
+    # consecutive, non-overlapping blocks of the cores this
+    # process may run on, wrapping around if oversubscribed
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    start = worker_id * threads_per_worker
+    return set(
+        cores[(start + i) % len(cores)] for i in range(threads_per_worker)
+    )
+
+
+def _inference_worker(worker_id, model, threads_per_worker,
+                      pin_cores, tasks, results):
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+    if pin_cores:
+        cores = _worker_cores(worker_id, threads_per_worker)
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+
+    with torch.no_grad():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            job_id, z1, z2, condition = task
+            try:
+                results.put((job_id, model.decoder(z1, z2, condition)))
+            except Exception as e:
+                # a failed request is sent back instead of killing the
+                # worker, and re-raised by the caller
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    e = RuntimeError(repr(e))
+                results.put((job_id, e))
+
+
+class InferencePool():
+    def __init__(self, model, n_workers=None, threads_per_worker=None,
+                 pin_cores=True):
+        # model is typically the output of load_ec_squared_vae; its
+        # weights are moved into shared memory once and every worker
+        # maps the same storage instead of holding its own replica
+        n_cores = os.cpu_count()
+        if n_workers is None:
+            n_workers = n_cores
+        if threads_per_worker is None:
+            threads_per_worker = max(1, n_cores // n_workers)
+
+        model = model.cpu().eval()
+        model.share_memory()
+
+        ctx = mp.get_context("spawn")
+        self.__tasks = ctx.Queue()
+        self.__results = ctx.Queue()
+        self.__next_id = 0
+        self.__workers = [
+            ctx.Process(
+                target=_inference_worker,
+                args=(i, model, threads_per_worker, pin_cores,
+                      self.__tasks, self.__results),
+                daemon=True
+            )
+            for i in range(n_workers)
+        ]
+        for worker in self.__workers:
+            worker.start()
+
+    def get_n_workers(self):
+        return len(self.__workers)
+
+    def submit(self, z1, z2, condition):
+        job_id = self.__next_id
+        self.__next_id += 1
+        self.__tasks.put((job_id, z1, z2, condition))
+
+        return job_id
+
+    def __next_result(self, poll_interval=1.):
+        # (job_id, decoder output or exception); workers only exit
+        # on close, so a dead worker means its request is lost
+        while True:
+            try:
+                return self.__results.get(timeout=poll_interval)
+            except queue.Empty:
+                dead = [w for w in self.__workers if not w.is_alive()]
+                if dead:
+                    raise RuntimeError(
+                        "inference worker exited with code {}".format(
+                            dead[0].exitcode)
+                    )
+
+    def get_result(self):
+        # (job_id, decoder output) of the next finished request,
+        # re-raising the exception of a failed one
+        job_id, output = self.__next_result()
+        if isinstance(output, Exception):
+            raise output
+
+        return job_id, output
+
+    def map(self, requests):
+        # requests are (z1, z2, condition) batches, results keep
+        # their order. Every result is collected before the first
+        # failure is re-raised, so none are left on the queue.
+        job_ids = [self.submit(*request) for request in requests]
+        outputs = dict(self.__next_result() for _ in job_ids)
+
+        for job_id in job_ids:
+            if isinstance(outputs[job_id], Exception):
+                raise outputs[job_id]
+
+        return [outputs[job_id] for job_id in job_ids]
+
+    def close(self):
+        for _ in self.__workers:
+            self.__tasks.put(None)
+        for worker in self.__workers:
+            worker.join()
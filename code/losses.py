@@ -0,0 +1,82 @@
+# losses.py
+#
+# source code for the fused EC^2 VAE training objective,
+# using closed form KL terms and cross entropy on logits
+
+
+# imports
+from torch.nn import functional as F
+
+
+# function definitions and implementations
+def kl_std_normal(mu, std):
+    # closed form KL(N(mu, std^2) || N(0, I)), averaged over
+    # every latent dimension, as kl_divergence(...).mean() does
+    return (0.5 * (std.pow(2) + mu.pow(2) - 1.) - std.log()).mean()
+
+
+def ec_squared_vae_loss(recon, recon_rhythm, target_tensor,
+                        rhythm_target, dis1m, dis1s, dis2m, dis2s,
+                        beta=.1, from_logits=True):
+    # recon and recon_rhythm are the decoder logits when the model
+    # was built with return_logits=True, log-probabilities otherwise
+    recon = recon.reshape(-1, recon.size(-1))
+    recon_rhythm = recon_rhythm.reshape(-1, recon_rhythm.size(-1))
+
+    if from_logits:
+        CE1 = F.cross_entropy(recon, target_tensor)
+        CE2 = F.cross_entropy(recon_rhythm, rhythm_target)
+    else:
+        CE1 = F.nll_loss(recon, target_tensor)
+        CE2 = F.nll_loss(recon_rhythm, rhythm_target)
+
+    KLD1 = kl_std_normal(dis1m, dis1s)
+    KLD2 = kl_std_normal(dis2m, dis2s)
+
+    loss = CE1 + CE2 + beta * (KLD1 + KLD2)
+
+    # detached device tensors, so logging them does not force a sync
+    terms = {
+        "loss": loss.detach(),
+        "pitch_ce": CE1.detach(),
+        "rhythm_ce": CE2.detach(),
+        "kld_1": KLD1.detach(),
+        "kld_2": KLD2.detach()
+    }
+
+    return loss, terms
+
+
+def distillation_loss(recon, recon_rhythm, dis1m, dis2m,
+                      teacher_recon, teacher_rhythm, teacher_dis1m,
+                      teacher_dis2m, temperature=2., latent_weight=1.):
+    # per-step pitch and rhythm distributions of the student matched
+    # to the teacher's logits, and its latent means to the teacher's
+    # so z1 and z2 keep their pitch/rhythm roles
+    recon = recon.reshape(-1, recon.size(-1))
+    recon_rhythm = recon_rhythm.reshape(-1, recon_rhythm.size(-1))
+    teacher_recon = teacher_recon.reshape(-1, teacher_recon.size(-1))
+    teacher_rhythm = teacher_rhythm.reshape(-1, teacher_rhythm.size(-1))
+
+    KD1 = F.kl_div(
+        F.log_softmax(recon / temperature, -1),
+        F.log_softmax(teacher_recon / temperature, -1),
+        reduction="batchmean", log_target=True
+    ) * temperature ** 2
+    KD2 = F.kl_div(
+        F.log_softmax(recon_rhythm / temperature, -1),
+        F.log_softmax(teacher_rhythm / temperature, -1),
+        reduction="batchmean", log_target=True
+    ) * temperature ** 2
+    MSE = F.mse_loss(dis1m, teacher_dis1m) + F.mse_loss(dis2m, teacher_dis2m)
+
+    loss = KD1 + KD2 + latent_weight * MSE
+
+    terms = {
+        "distill_loss": loss.detach(),
+        "pitch_kd": KD1.detach(),
+        "rhythm_kd": KD2.detach(),
+        "latent_mse": MSE.detach()
+    }
+
+    return loss, terms
@@ -7,39 +7,56 @@
 # imports
 import json
 import os
+import time
 
 from ec_squared_vae import ECSquaredVAE
-from utils import (
-    MinExponentialLR, std_normal, loss_function
-)
+from utils import MinExponentialLR, unwrap_model, prepare_batch
+from losses import ec_squared_vae_loss, distillation_loss
+from autotune import find_batch_size
+from evaluate import AsyncEvaluator
+from distill import load_teacher, teacher_targets
+from metrics import MetricsLogger
 from data_loader import MusicArrayLoader
 
-import numpy as np
-
 import torch
 from torch import optim
-from torch.distributions import Normal
 from tensorboardX import SummaryWriter
 
 
 # function definitions and implementations
-def configure_model(config_file_path):
+def configure_model(config_file_path, overrides=None):
     with open(config_file_path) as f:
         args = json.load(f)
 
-    if not os.path.isdir("ec_squared_vae/log"):
-        os.mkdir("ec_squared_vae/log")
+    if overrides is not None:
+        args.update(overrides)
+
+    # the student is saved under name, which must not overwrite
+    # the teacher checkpoint it is distilled from
+    if args.get("distill", False) and args["name"] == args["teacher_name"]:
+        raise ValueError(
+            "distill needs a student name different from teacher_name "
+            "'{}'".format(args["teacher_name"])
+        )
+
+    log_root = args.get("log_dir", "ec_squared_vae/log")
+    params_root = args.get("params_dir", "ec_squared_vae/params")
+
+    if not os.path.isdir(log_root):
+        os.makedirs(log_root)
 
-    if not os.path.isdir("ec_squared_vae/params"):
-        os.mkdir("ec_squared_vae/params")
+    if not os.path.isdir(params_root):
+        os.makedirs(params_root)
 
-    save_path = "ec_squared_vae/params/{}.pt".format(args["name"])
-    writer = SummaryWriter("ec_squared_vae/log/{}".format(args["name"]))
+    save_path = os.path.join(params_root, "{}.pt".format(args["name"]))
+    log_dir = os.path.join(log_root, args["name"])
+    writer = SummaryWriter(log_dir)
 
     model = ECSquaredVAE(
         args["roll_dim"], args["hidden_dim"], args["rhythm_dim"], 
         args["condition_dims"], args["z1_dim"],
-        args["z2_dim"], args["time_step"]
+        args["z2_dim"], args["time_step"], return_logits=True,
+        checkpoint_segment=args.get("checkpoint_segment", 0)
     )
 
     if args["if_parallel"]:
@@ -63,72 +80,151 @@ def configure_model(config_file_path):
     step, pre_epoch = 0, 0
     model.train()
 
-    dl = MusicArrayLoader(args["data_path"], args["time_step"], 16)
+    dl = MusicArrayLoader(
+        args["data_path"], args["time_step"], 16,
+        weighted=args.get("weighted_sampling", False),
+        split=args.get("train_split"),
+        augment_shift=args.get("augment_shift", False),
+        verbose=args.get("log_verbosity", 1) >= 2
+    )
     dl.chunking()
+    if args.get("train_view"):
+        # e.g. {"song": [...], "key": 0, "window_range": [0, 4]}
+        dl.set_view(dl.find_windows(
+            split=args.get("train_split"), **args["train_view"]
+        ))
+    print("Duplicate ratio: {:.4f}".format(dl.get_duplicate_ratio()))
 
-    return (model, args, save_path, writer, 
-            scheduler, step, pre_epoch, dl, optimizer)
+    # a smaller student trained against a frozen teacher checkpoint
+    teacher = None
+    if args.get("distill", False):
+        teacher = load_teacher(args, params_root)
+        print("Distilling from: ", args["teacher_name"])
 
+    if args.get("auto_batch_size", False):
+        args["micro_batch_size"] = tune_micro_batch_size(
+            model, args, dl, teacher
+        )
 
-def train(model, args, writer, scheduler, step, dl, optimizer):
-    batch, c = dl.get_batch(args["batch_size"])
-    print(batch.shape, c.shape)
-    encode_tensor = torch.from_numpy(batch).float()
-    c = torch.from_numpy(c).float()
-
-    rhythm_target = np.expand_dims(batch[:, :, :-2].sum(-1), -1)
-    rhythm_target = np.concatenate((rhythm_target, batch[:, :, -2:]), -1)
-    rhythm_target = torch.from_numpy(rhythm_target).float()
-    rhythm_target = rhythm_target.view(
-        -1, rhythm_target.size(-1)
-    ).max(-1)[1]
-    target_tensor = encode_tensor.view(
-        -1, encode_tensor.size(-1)
-    ).max(-1)[1]
+    evaluator = None
+    if args.get("eval_interval", 0) > 0:
+        evaluator = AsyncEvaluator(args, log_dir)
 
-    if torch.cuda.is_available():
-        encode_tensor = encode_tensor.cuda()
-        target_tensor = target_tensor.cuda()
-        rhythm_target = rhythm_target.cuda()
-        c = c.cuda()
+    return (model, args, save_path, writer, scheduler,
+            step, pre_epoch, dl, optimizer, evaluator, teacher)
 
-    optimizer.zero_grad()
+
+def compute_loss(model, args, encode_tensor, c,
+                 target_tensor, rhythm_target, teacher=None):
     recon, recon_rhythm, dis1m, dis1s, dis2m, dis2s = model(encode_tensor, c)
-    distribution_1 = Normal(dis1m, dis1s)
-    distribution_2 = Normal(dis2m, dis2s)
 
-    loss = loss_function(
+    loss, terms = ec_squared_vae_loss(
         recon,
         recon_rhythm,
         target_tensor,
         rhythm_target,
-        distribution_1,
-        distribution_2,
-        step,
+        dis1m, dis1s,
+        dis2m, dis2s,
         beta=args["beta"]
     )
-    loss.backward()
+
+    if teacher is not None:
+        distill_loss, distill_terms = distillation_loss(
+            recon, recon_rhythm, dis1m, dis2m,
+            *teacher_targets(teacher, encode_tensor, c),
+            temperature=args["distill_temperature"],
+            latent_weight=args["distill_latent_weight"]
+        )
+        alpha = args["distill_alpha"]
+        loss = (1 - alpha) * loss + alpha * distill_loss
+        terms.update(distill_terms)
+        terms["loss"] = loss.detach()
+
+    return loss, terms
+
+
+def tune_micro_batch_size(model, args, dl, teacher=None):
+    # probe with real samples, then rewind the loader
+    def step_fn(batch_size):
+        batch, c = dl.get_batch(batch_size)
+        dl.reset()
+        loss, _ = compute_loss(
+            model, args, *prepare_batch(batch, c), teacher=teacher
+        )
+        loss.backward()
+
+    # the frozen teacher is held for the whole step
+    resident_bytes = 0
+    if teacher is not None:
+        resident_bytes = sum(
+            p.numel() * p.element_size() for p in teacher.parameters()
+        )
+
+    micro_batch_size, _ = find_batch_size(
+        unwrap_model(model), step_fn, args["memory_budget_mb"],
+        min(args["batch_size"], dl.get_n_sample()),
+        resident_bytes=resident_bytes
+    )
+    print("Using micro batch size: ", micro_batch_size)
+
+    return micro_batch_size
+
+
+def train(model, args, logger, scheduler, step, dl, optimizer,
+          teacher=None):
+    batch, c = dl.get_batch(args["batch_size"])
+    logger.debug(batch.shape, c.shape)
+    if len(batch) == 0:
+        # the previous batch ended exactly on the epoch boundary
+        dl.shuffle_samples()
+        return step
+
+    micro_batch_size = args.get("micro_batch_size") or len(batch)
+
+    optimizer.zero_grad()
+    batch_terms = {}
+    for i in range(0, len(batch), micro_batch_size):
+        micro_batch = batch[i:i + micro_batch_size]
+        loss, terms = compute_loss(
+            model, args,
+            *prepare_batch(micro_batch, c[i:i + micro_batch_size]),
+            teacher=teacher
+        )
+        # weight each micro-batch so the accumulated gradient
+        # equals that of the full batch
+        weight = len(micro_batch) / len(batch)
+        (loss * weight).backward()
+        for name, value in terms.items():
+            batch_terms[name] = batch_terms.get(name, 0.) + value * weight
+
     torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
     optimizer.step()
     step += 1
 
-    print("batch loss: {:.5f}".format(loss.item()))
-    writer.add_scalar("batch_loss", loss.item(), step)
+    logger.update(batch_terms, step)
     if args["decay"] > 0:
         scheduler.step()
+    unwrap_model(model).update_eps()
     dl.shuffle_samples()
 
     return step
 
 
-def main():
-    config_fname = "ec_squared_vae/code/ec_squared_vae_model_config.json"
-
-    (model, args, save_path, writer, scheduler,
-     step, pre_epoch, dl, optimizer) = configure_model(config_fname)
+def run_training(config_fname, overrides=None):
+    (model, args, save_path, writer, scheduler, step, pre_epoch,
+     dl, optimizer, evaluator, teacher) = configure_model(
+         config_fname, overrides
+    )
+    logger = MetricsLogger(
+        writer, args.get("log_interval", 50), args.get("log_verbosity", 1)
+    )
 
+    start = time.perf_counter()
     while dl.get_n_epoch() < args["n_epochs"]:
-        step = train(model, args, writer, scheduler, step, dl, optimizer)
+        step = train(model, args, logger, scheduler, step, dl, optimizer,
+                     teacher)
+        if evaluator is not None and step % args["eval_interval"] == 0:
+            evaluator.submit(unwrap_model(model), step)
         if dl.get_n_epoch() != pre_epoch:
             pre_epoch = dl.get_n_epoch()
             torch.save(model.cpu().state_dict(), save_path)
@@ -136,6 +232,25 @@ def main():
             if torch.cuda.is_available():
                 model.cuda()
             print("Model saved!")
+    elapsed = time.perf_counter() - start
+
+    if evaluator is not None:
+        evaluator.close()
+    logger.close(step)
+
+    # every epoch visits each training window once
+    summary = {
+        "steps": step,
+        "train_time": elapsed,
+        "samples_per_sec": args["n_epochs"] * dl.get_n_sample() / elapsed
+    }
+
+    return model, args, summary
+
+
+def main():
+    config_fname = "ec_squared_vae/code/ec_squared_vae_model_config.json"
+    run_training(config_fname)
 
 if __name__ == "__main__":
     main()
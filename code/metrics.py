@@ -0,0 +1,85 @@
+# metrics.py
+#
+# source code for low-overhead training metrics logging, reducing
+# on-device scalars and writing them from a background thread
+
+
+# imports
+import queue
+import threading
+
+import torch
+
+
+# class definition
+class MetricsLogger():
+    def __init__(self, writer, log_interval=50, verbosity=1,
+                 max_queue=64):
+        # verbosity 0 only writes to TensorBoard, 1 also prints each
+        # reduced interval, 2 also prints per-step debugging output
+        self.writer = writer
+        self.log_interval = max(1, log_interval)
+        self.verbosity = verbosity
+        self.dropped = 0
+        self.__sums = {}
+        self.__n_steps = 0
+        self.__records = queue.Queue(maxsize=max_queue)
+        self.__thread = threading.Thread(target=self.__write, daemon=True)
+        self.__thread.start()
+
+    def update(self, terms, step):
+        # terms are detached device scalars; adding them up stays on
+        # the device, so no step forces a sync
+        for name, value in terms.items():
+            self.__sums[name] = self.__sums.get(name, 0.) + value
+        self.__n_steps += 1
+
+        if self.__n_steps >= self.log_interval:
+            self.flush(step)
+
+    def flush(self, step):
+        if self.__n_steps == 0:
+            return
+
+        names = list(self.__sums)
+        means = torch.stack(
+            [torch.as_tensor(self.__sums[name]) for name in names]
+        ) / self.__n_steps
+        self.__sums = {}
+        self.__n_steps = 0
+
+        # the writer thread copies the means to the host, the training
+        # thread drops the record rather than wait on a full queue
+        try:
+            self.__records.put_nowait((step, names, means.detach()))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, *message):
+        if self.verbosity >= 2:
+            print(*message)
+
+    def __write(self):
+        while True:
+            record = self.__records.get()
+            if record is None:
+                break
+
+            step, names, means = record
+            values = means.tolist()
+            for name, value in zip(names, values):
+                # batch_loss keeps the tag earlier runs were logged under
+                tag = "batch_loss" if name == "loss" else name
+                self.writer.add_scalar(tag, value, step)
+
+            if self.verbosity >= 1:
+                print("step {}: {}".format(step, ", ".join(
+                    "{} {:.5f}".format(name, value)
+                    for name, value in zip(names, values)
+                )))
+
+    def close(self, step):
+        self.flush(step)
+        self.__records.put(None)
+        self.__thread.join()
+        self.writer.close()
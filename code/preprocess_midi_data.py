@@ -248,6 +248,7 @@ import glob
 import os
 import random
 import argparse
+import hashlib
 import pickle
 import numpy as np
 import pretty_midi as pm
@@ -262,8 +263,15 @@ def pad_pianorolls(pianoroll, timelen):
     return pianoroll
 
 
+def window_hash(pitch_list, chord_list):
+    # identical token and chord arrays give identical digests
+    pitch_bytes = np.asarray(pitch_list, dtype=np.int16).tobytes()
+    chord_bytes = np.asarray(chord_list, dtype=np.uint8).tobytes()
+    return hashlib.sha1(pitch_bytes + chord_bytes).digest()
+
+
 def make_instance_pkl_files(root_dir, midi_dir, num_bars, frame_per_bar, pitch_range=48, shift=False,
-                            beat_per_bar=4, bpm=120, data_ratio=(0.8, 0.1, 0.1)):
+                            beat_per_bar=4, bpm=120, data_ratio=(0.8, 0.1, 0.1), dedup=True):
     if shift:
         instance_folder = 'instance_pkl_%dbars_fpb%d_%dp_12keys' % (num_bars, frame_per_bar, pitch_range)
     else:
@@ -291,15 +299,32 @@ def make_instance_pkl_files(root_dir, midi_dir, num_bars, frame_per_bar, pitch_r
     num_eval = int(len(song_list) * data_ratio[1])
     num_test = int(len(song_list) * data_ratio[2])
     random.seed(0)
-    eval_test_cand = set([song.split('/')[-1] for song in song_list])
-    eval_set = random.sample(eval_test_cand, num_eval)
-    test_set = random.sample(eval_test_cand - set(eval_set), num_test)
+    eval_test_cand = set([os.path.splitext(os.path.basename(song))[0] for song in song_list])
+    eval_set = random.sample(sorted(eval_test_cand), num_eval)
+    test_set = random.sample(sorted(eval_test_cand - set(eval_set)), num_test)
 
     pitches = []
     chords = []
+    counts = []
+    splits = []
+    # lowest and highest onset over the instance_len + 1 frames the
+    # base note and range check use, relative to the base note
+    onset_lows = []
+    onset_highs = []
+    # columnar metadata of every window occurrence, including the
+    # duplicates, each pointing at the kept window it resolves to.
+    # Song titles are stored once.
+    song_names = []
+    song_codes = {}
+    window_songs = []
+    window_keys = []
+    window_offsets = []
+    kept_index = []
+    seen_windows = {}
+    n_windows = 0
 
     for midi_file in tqdm(midi_files[:5], desc="Processing"):
-        song_title = midi_file.split('/')[-2]
+        song_title = os.path.splitext(os.path.basename(midi_file))[0]
         filename = midi_file.split('/')[-1].split('.')[0]
 
         if song_title in eval_set:
@@ -427,9 +452,34 @@ def make_instance_pkl_files(root_dir, midi_dir, num_bars, frame_per_bar, pitch_r
                     
                 pitch_info = np.array(pitch_info)
                 chord_result = np.array(chord_list)
-                
+
+                n_windows += 1
+                if song_title not in song_codes:
+                    song_codes[song_title] = len(song_names)
+                    song_names.append(song_title)
+                window_songs.append(song_codes[song_title])
+                window_keys.append(k)
+                window_offsets.append(i // stride)
+
+                # keep one copy of byte-identical windows, counting repeats
+                if dedup:
+                    # windows are only merged within a split, so
+                    # deduplication cannot leak eval data into train
+                    key = (mode, window_hash(pitch_list, chord_list))
+                    if key in seen_windows:
+                        counts[seen_windows[key]] += 1
+                        kept_index.append(seen_windows[key])
+                        continue
+                    seen_windows[key] = len(pitches)
+
+                kept_index.append(len(pitches))
                 pitches.append(pitch_info)
                 chords.append(chord_result)
+                counts.append(1)
+                splits.append(mode)
+                onset_notes = onset_inst.T.nonzero()[1]
+                onset_lows.append(min(onset_notes) - base_note)
+                onset_highs.append(max(onset_notes) - base_note)
                 
                 # print()
                 # print(len(pitches))
@@ -461,9 +511,23 @@ def make_instance_pkl_files(root_dir, midi_dir, num_bars, frame_per_bar, pitch_r
     print(chord_result.shape)
     print()
     
+    n_duplicates = n_windows - len(counts)
+    print('kept %d of %d windows, duplicate ratio: %.4f' % (
+        len(counts), n_windows, n_duplicates / max(n_windows, 1)))
+    print()
+
     data = {
         'pitch': pitches,
-        'chord': chords
+        'chord': chords,
+        'count': np.array(counts, dtype=np.int64),
+        'split': np.array(splits),
+        'onset_low': np.array(onset_lows, dtype=np.int16),
+        'onset_high': np.array(onset_highs, dtype=np.int16),
+        'song': np.array(window_songs, dtype=np.int32),
+        'song_names': np.array(song_names),
+        'key': np.array(window_keys, dtype=np.int8),
+        'window': np.array(window_offsets, dtype=np.int32),
+        'kept_index': np.array(kept_index, dtype=np.int32)
     }
     
     # save data here
@@ -479,6 +543,7 @@ if __name__ == '__main__':
     parser.add_argument('--frame_per_bar', type=int, default=16)
     parser.add_argument('--pitch_range', type=int, default=128)
     parser.add_argument('--shift', dest='shift', action='store_true')
+    parser.add_argument('--keep_duplicates', dest='dedup', action='store_false')
 
     args = parser.parse_args()
     root_dir = args.root_dir
@@ -487,6 +552,7 @@ if __name__ == '__main__':
     frame_per_bar = args.frame_per_bar
     pitch_range = args.pitch_range
     shift = args.shift
+    dedup = args.dedup
 
-    make_instance_pkl_files(root_dir, midi_dir, num_bars, frame_per_bar, pitch_range, shift)
+    make_instance_pkl_files(root_dir, midi_dir, num_bars, frame_per_bar, pitch_range, shift, dedup=dedup)
     
\ No newline at end of file
@@ -0,0 +1,118 @@
+# rhythm_cache.py
+#
+# source code for memoising EC^2 VAE rhythm decoder outputs by
+# rhythm latent z2, for analogy workloads that reuse one rhythm
+
+
+# imports
+from collections import OrderedDict
+
+import torch
+
+
+# class definition
+class RhythmCache():
+    def __init__(self, model, max_entries=1024, max_bytes=None,
+                 quantize=None):
+        # the rhythm decoder output depends only on z2, and is
+        # deterministic in eval mode. With quantize set, latents
+        # within the same quantize-sized cell share one entry.
+        self.model = model.eval()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.quantize = quantize
+        self.__entries = OrderedDict()
+        self.__n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.evictions = 0
+
+    def _key(self, z):
+        if self.quantize is not None:
+            return torch.round(z / self.quantize).long().numpy().tobytes()
+
+        return z.numpy().tobytes()
+
+    def _insert(self, key, rhythm):
+        self.__entries[key] = rhythm
+        self.__n_bytes += rhythm.numel() * rhythm.element_size()
+
+        while self.__entries and (
+                (self.max_entries is not None
+                 and len(self.__entries) > self.max_entries)
+                or (self.max_bytes is not None
+                    and self.__n_bytes > self.max_bytes)):
+            _, evicted = self.__entries.popitem(last=False)
+            self.__n_bytes -= evicted.numel() * evicted.element_size()
+            self.evictions += 1
+
+    @torch.no_grad()
+    def get_rhythm(self, z2):
+        # (batch, z2_dims) -> (batch, n_step, rhythm_dims), decoding
+        # only the latents that are not cached, in one batch
+        keys = [self._key(z) for z in z2.detach().cpu()]
+        rhythms = [self.__entries.get(key) for key in keys]
+
+        missing = {}
+        for i, (key, rhythm) in enumerate(zip(keys, rhythms)):
+            if rhythm is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                self.__entries.move_to_end(key)
+        # each distinct latent of the batch is one lookup; repeats
+        # within the batch are counted apart, so the hit rate only
+        # reflects reuse across calls
+        n_distinct = len(set(keys))
+        self.hits += n_distinct - len(missing)
+        self.misses += len(missing)
+        self.deduplicated += len(keys) - n_distinct
+
+        if missing:
+            rows = [idx[0] for idx in missing.values()]
+            decoded = self.model.rhythm_decoder(z2[rows])
+            for (key, idx), rhythm in zip(missing.items(), decoded):
+                for i in idx:
+                    rhythms[i] = rhythm
+                self._insert(key, rhythm.clone())
+
+        return torch.stack(rhythms, 0)
+
+    @torch.no_grad()
+    def decode(self, z1, z2, condition):
+        # same output as ECSquaredVAE.decoder in eval mode
+        rhythm = self.get_rhythm(z2)
+
+        return self.model.final_decoder(
+            z1, self.model.rhythm_input(rhythm), condition
+        )
+
+    @torch.no_grad()
+    def decode_variants(self, z1, z2, condition):
+        # many pitch latents (batch, z1_dims) and conditions
+        # (batch, n_step, 12) against a single rhythm latent z2
+        rhythm = self.get_rhythm(z2.view(1, -1))
+        rhythm = rhythm.expand(z1.size(0), -1, -1)
+
+        return self.model.final_decoder(
+            z1, self.model.rhythm_input(rhythm), condition
+        )
+
+    def hit_rate(self):
+        n_lookups = self.hits + self.misses
+        return self.hits / n_lookups if n_lookups else 0.
+
+    def get_stats(self):
+        return {
+            "entries": len(self.__entries),
+            "bytes": self.__n_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate()
+        }
+
+    def clear(self):
+        self.__entries.clear()
+        self.__n_bytes = 0
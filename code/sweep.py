@@ -0,0 +1,191 @@
+# sweep.py
+#
+# source code for running concurrent hyperparameter sweeps of
+# the EC^2 VAE over keys of the model config
+
+
+# imports
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import torch
+
+from data_loader import MusicArrayLoader, save_memmap_dataset
+from evaluate import evaluate
+from utils import unwrap_model
+
+
+# function definitions and implementations
+def _sample_value(spec, rng):
+    # a list is sampled uniformly, {"uniform": [lo, hi]} and
+    # {"log_uniform": [lo, hi]} are sampled from that range
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if "uniform" in spec:
+        return rng.uniform(*spec["uniform"])
+    if "log_uniform" in spec:
+        lo, hi = spec["log_uniform"]
+        return math.exp(rng.uniform(math.log(lo), math.log(hi)))
+
+    raise ValueError("unknown sweep parameter spec: {}".format(spec))
+
+
+def expand_sweep(sweep):
+    # returns one dict of config overrides per run
+    params = sweep["params"]
+    if sweep.get("mode", "grid") == "grid":
+        keys = sorted(params)
+        return [
+            dict(zip(keys, values))
+            for values in itertools.product(*(params[k] for k in keys))
+        ]
+
+    rng = random.Random(sweep.get("seed", 0))
+    return [
+        {k: _sample_value(spec, rng) for k, spec in sorted(params.items())}
+        for _ in range(sweep["n_runs"])
+    ]
+
+
+def _init_worker(threads_per_run):
+    # limit each sweep worker to its share of the cores before
+    # any parallel work starts
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_run)
+    torch.set_num_threads(threads_per_run)
+    torch.set_num_interop_threads(1)
+
+
+def _run(config_fname, overrides):
+    from main import run_training
+
+    model, args, summary = run_training(config_fname, overrides)
+    model = unwrap_model(model)
+
+    dl = MusicArrayLoader(
+        args["data_path"], args["time_step"], 16,
+        split=args.get("eval_split", "eval")
+    )
+    dl.chunking()
+    if dl.get_n_sample() > 0:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        summary.update(evaluate(model.to(device), dl, args, device))
+
+    return summary
+
+
+def run_sweep(config_fname, sweep, out_dir, n_parallel=None,
+              threads_per_run=None):
+    with open(config_fname) as f:
+        base_args = json.load(f)
+
+    n_cores = os.cpu_count()
+    if n_parallel is None:
+        n_parallel = max(1, n_cores // (threads_per_run or 1))
+    if threads_per_run is None:
+        threads_per_run = max(1, n_cores // n_parallel)
+
+    # every run maps the same read-only copy of the dataset
+    data_dir = save_memmap_dataset(
+        base_args["data_path"], os.path.join(out_dir, "data")
+    )
+
+    runs = expand_sweep(sweep)
+    jobs = []
+    for i, params in enumerate(runs):
+        name = "{}_sweep{:03d}".format(base_args["name"], i)
+        overrides = dict(params)
+        overrides.update({
+            "name": name,
+            "data_path": data_dir,
+            "log_dir": os.path.join(out_dir, "log"),
+            "params_dir": os.path.join(out_dir, "params"),
+            "if_parallel": False,
+            # evaluated once at the end, see _run
+            "eval_interval": 0
+        })
+        jobs.append((name, params, overrides))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=n_parallel,
+                             mp_context=get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(threads_per_run,)) as pool:
+        futures = {
+            pool.submit(_run, config_fname, overrides):
+                (name, params)
+            for name, params, overrides in jobs
+        }
+        for future in as_completed(futures):
+            name, params = futures[future]
+            summary = future.result()
+            print("finished {}: {}".format(name, summary))
+            results.append(dict(name=name, **params, **summary))
+
+    results.sort(key=lambda r: r["name"])
+    write_summary(results, os.path.join(out_dir, "summary.csv"))
+
+    return results
+
+
+def write_summary(results, path):
+    columns = []
+    for result in results:
+        columns += [k for k in result if k not in columns]
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+    widths = [
+        max(len(c), *(len(_format(r.get(c, ""))) for r in results))
+        for c in columns
+    ]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        print("  ".join(
+            _format(result.get(c, "")).ljust(w)
+            for c, w in zip(columns, widths)
+        ))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return "{:.4g}".format(value)
+
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config", type=str,
+        default="ec_squared_vae/code/ec_squared_vae_model_config.json"
+    )
+    parser.add_argument("--sweep", type=str, required=True)
+    parser.add_argument("--out_dir", type=str, default=None)
+    parser.add_argument("--n_parallel", type=int, default=None)
+    parser.add_argument("--threads_per_run", type=int, default=None)
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep = json.load(f)
+
+    out_dir = args.out_dir or os.path.join(
+        "ec_squared_vae/sweeps",
+        os.path.splitext(os.path.basename(args.sweep))[0]
+    )
+    run_sweep(args.config, sweep, out_dir,
+              n_parallel=args.n_parallel,
+              threads_per_run=args.threads_per_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 # source code for utility functions
 
 # imports
+import numpy as np
 import torch
 from torch.distributions import kl_divergence, Normal
 from torch.optim.lr_scheduler import ExponentialLR
@@ -23,6 +24,50 @@ class MinExponentialLR(ExponentialLR):
         ]
 
 
+def unwrap_model(model):
+    # DataParallel keeps the EC^2 VAE, and its schedule state,
+    # on the wrapped module
+    if isinstance(model, torch.nn.DataParallel):
+        return model.module
+
+    return model
+
+
+def load_checkpoint(model, path):
+    # params saved from a DataParallel model carry a 'module.' prefix
+    state_dict = torch.load(path, map_location="cpu")
+    state_dict = {
+        (k[len("module."):] if k.startswith("module.") else k): v
+        for k, v in state_dict.items()
+    }
+    model.load_state_dict(state_dict)
+
+    return model
+
+
+def prepare_batch(batch, c, device=None):
+    # one-hot pitch rolls and chords to model inputs and the flat
+    # pitch and rhythm token targets
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    encode_tensor = torch.from_numpy(batch).float()
+    c = torch.from_numpy(c).float()
+
+    rhythm_target = np.expand_dims(batch[:, :, :-2].sum(-1), -1)
+    rhythm_target = np.concatenate((rhythm_target, batch[:, :, -2:]), -1)
+    rhythm_target = torch.from_numpy(rhythm_target).float()
+    rhythm_target = rhythm_target.view(
+        -1, rhythm_target.size(-1)
+    ).max(-1)[1]
+    target_tensor = encode_tensor.view(
+        -1, encode_tensor.size(-1)
+    ).max(-1)[1]
+
+    return (encode_tensor.to(device), c.to(device),
+            target_tensor.to(device), rhythm_target.to(device))
+
+
 def std_normal(shape):
     N = Normal(torch.zeros(shape), torch.ones(shape))
 
@@ -40,12 +85,12 @@ def loss_function(recon, recon_rhythm, target_tensor,
     CE1 = F.nll_loss(
         recon.view(-1, recon.size(-1)),
         target_tensor,
-        reduction="elementwise_mean"
+        reduction="mean"
     )
     CE2 = F.nll_loss(
         recon_rhythm.view(-1, recon_rhythm.size(-1)),
         rhythm_target,
-        reduction="elementwise_mean"
+        reduction="mean"
     )
 
     normal1 = std_normal(distribution_1.mean.size())